@@ -1,5 +1,6 @@
 from app import db
 from flask_login import UserMixin
+from sqlalchemy.orm import declared_attr
 from datetime import datetime
 
 
@@ -28,32 +29,46 @@ class Staff(db.Model):
     FacilityFees_Percent = db.Column(db.Float, nullable=False, default=0.0)
     invoices = db.relationship('Invoice', backref='staff', lazy=True)  # One-to-Many with Invoice
 
-# Invoice Table
-class Invoice(db.Model):
-    InvID = db.Column(db.Integer, primary_key=True)
+# Invoice columns shared by Invoice and InvoiceArchive, so archiving never drops a column
+class InvoiceColumns:
     InvNumber = db.Column(db.String(50), unique=True, nullable=False)
     InvDate = db.Column(db.Date, nullable=False)
-    RefEmpID = db.Column(db.Integer, db.ForeignKey('staff.EmpID'), nullable=False)  # Foreign Key to Staff
     GrossAmount = db.Column(db.Float, nullable=False)
     FacilityFees = db.Column(db.Float, nullable=True)
     GST = db.Column(db.Float, nullable=True)
     OtherDeduction = db.Column(db.Float, nullable=True)
     NetAmount = db.Column(db.Float, nullable=True)
     PaidOn = db.Column(db.Date, nullable=True)
-    RefPeriodSerial = db.Column(db.Integer, db.ForeignKey('pay_period.PeriodSerial'), nullable=True)  # Foreign Key to PayPeriod
     PayType = db.Column(db.String(50), nullable=True)
-    billings = db.relationship('Billing', backref='invoice', lazy=True)  # One-to-Many with Billing
 
-# Billing Table
-class Billing(db.Model):
-    BillingID = db.Column(db.Integer, primary_key=True)
+    @declared_attr
+    def RefEmpID(cls):
+        return db.Column(db.Integer, db.ForeignKey('staff.EmpID'), nullable=False)  # Foreign Key to Staff
+
+    @declared_attr
+    def RefPeriodSerial(cls):
+        return db.Column(db.Integer, db.ForeignKey('pay_period.PeriodSerial'), nullable=True)  # Foreign Key to PayPeriod
+
+# Billing columns shared by Billing and BillingArchive (RefInvID differs, so each model declares it)
+class BillingColumns:
     BillingDate = db.Column(db.Date, nullable=False)
     BillingAmount = db.Column(db.Float, nullable=False)
     BillingType = db.Column(db.String(50), nullable=False)
     BillingRef = db.Column(db.String(100), nullable=True)
-    RefInvID = db.Column(db.Integer, db.ForeignKey('invoice.InvID'), nullable=False)  # Foreign Key to Invoice
     Field1 = db.Column(db.String(100), nullable=True)
 
+# Invoice Table
+class Invoice(InvoiceColumns, db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}  # Never reuse an InvID that was moved to the archive
+    InvID = db.Column(db.Integer, primary_key=True)
+    billings = db.relationship('Billing', backref='invoice', lazy=True)  # One-to-Many with Billing
+
+# Billing Table
+class Billing(BillingColumns, db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}  # Never reuse a BillingID that was moved to the archive
+    BillingID = db.Column(db.Integer, primary_key=True)
+    RefInvID = db.Column(db.Integer, db.ForeignKey('invoice.InvID'), nullable=False)  # Foreign Key to Invoice
+
 # PayPeriod Table
 class PayPeriod(db.Model):
     PeriodSerial = db.Column(db.Integer, primary_key=True)
@@ -61,4 +76,17 @@ class PayPeriod(db.Model):
     Period_End_Date = db.Column(db.Date, nullable=False)
     invoices = db.relationship('Invoice', backref='pay_period', lazy=True)  # One-to-Many with Invoice
 
+# InvoiceSequence Table
+class InvoiceSequence(db.Model):
+    RefPeriodSerial = db.Column(db.Integer, db.ForeignKey('pay_period.PeriodSerial'), primary_key=True)  # One counter per PayPeriod
+    NextValue = db.Column(db.Integer, nullable=False, default=1)  # First number not yet handed out to any worker
+
+# InvoiceArchive Table (Invoices from closed PayPeriods)
+class InvoiceArchive(InvoiceColumns, db.Model):
+    InvID = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Keeps the original InvID so receipt links still work
+    billings = db.relationship('BillingArchive', backref='invoice', lazy=True)  # One-to-Many with BillingArchive
 
+# BillingArchive Table (Billings of archived Invoices)
+class BillingArchive(BillingColumns, db.Model):
+    BillingID = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Keeps the original BillingID
+    RefInvID = db.Column(db.Integer, db.ForeignKey('invoice_archive.InvID'), nullable=False)  # Foreign Key to InvoiceArchive
@@ -1,9 +1,13 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, send_file, abort
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, send_file, abort, Response
 from flask_login import login_user, logout_user, login_required, current_user, LoginManager
-from app.models import db, User, Invoice, Billing, PayPeriod, Staff
-from app.utils import generate_pdf
+from app.models import db, User, Invoice, Billing, PayPeriod, Staff, InvoiceArchive, BillingArchive
+from app.utils import (
+    generate_pdf, allocate_invoice_number, invoice_number_exists, normalize_invoice_number,
+    archive_closed_pay_periods, get_receipt_records,
+    doctor_fee_details, doctor_fee_snapshot
+)
 from sqlalchemy.exc import IntegrityError
-from datetime import date
+from datetime import date, MINYEAR, MAXYEAR
 import os
 
 # Create a Blueprint for organizing routes (like a mini-app within Flask)
@@ -117,17 +121,24 @@ def create_invoice():
     try:
         if request.method == 'POST':
             # Get form data
-            inv_number = request.form.get('inv_number')
+            inv_number = normalize_invoice_number(request.form.get('inv_number'))
             inv_date = request.form.get('inv_date')
             paid_date = request.form.get('paid_date')
             doctor_id = request.form.get('doctor')
-            pay_period_id = request.form.get('pay_period')
+            pay_period_id = request.form.get('pay_period', type=int)
 
-            # Validate required fields
-            if not inv_number or not doctor_id or not pay_period_id:
+            # Validate required fields (the pay period must exist before a number is allocated for it)
+            if not doctor_id or not pay_period_id or not PayPeriod.query.get(pay_period_id):
                 flash("Missing required fields. Please fill out the form completely.", "danger")
                 return redirect(url_for('main.create_invoice'))
 
+            # Allocate a number server-side when none was typed, otherwise reject duplicates before inserting
+            if not inv_number:
+                inv_number = allocate_invoice_number(pay_period_id)
+            elif invoice_number_exists(inv_number):
+                flash('Invoice number already exists. Please use a unique invoice number.', 'danger')
+                return redirect(url_for('main.create_invoice'))
+
             # Parse date fields
             inv_date = date.fromisoformat(inv_date) if inv_date else None
             paid_date = date.fromisoformat(paid_date) if paid_date else None
@@ -171,7 +182,28 @@ def create_invoice():
     if not pay_periods or not doctors:
         flash("Pay Periods or Doctors data is missing. Please ensure the database is properly populated.", "warning")
 
-    return render_template('create_invoice.html', pay_periods=pay_periods, doctors=doctors)
+    # The form loads every doctor's fees from /doctor_fees.json?v=<version>, which the browser caches per version
+    _, doctor_fees_version = doctor_fee_snapshot(doctors)
+
+    return render_template(
+        'create_invoice.html',
+        pay_periods=pay_periods,
+        doctors=doctors,
+        doctor_fees_version=doctor_fees_version
+    )
+
+# Route to Check Invoice Number Availability (AJAX)
+@main.route('/check_invoice_number')
+@login_required
+def check_invoice_number():
+    inv_number = normalize_invoice_number(request.args.get('inv_number'))
+    if not inv_number:
+        return jsonify({'error': 'Invoice number is required'}), 400
+
+    return jsonify({
+        'inv_number': inv_number,
+        'available': not invoice_number_exists(inv_number)
+    })
 
 # Route to Add Billings
 @main.route('/add_billings/<int:invoice_id>', methods=['GET', 'POST'])
@@ -211,20 +243,49 @@ def get_doctor_details(doctor_id):
     if not doctor:
         return jsonify({'error': 'Doctor not found'}), 404
 
-    gst = doctor.FacilityFees_Percent * 0.1
+    return jsonify(doctor_fee_details(doctor))
 
-    return jsonify({
-        'facility_fee': doctor.FacilityFees_Percent,
-        'gst': gst
-    })
+# Route to Fetch Many Doctors' Details at Once (AJAX): /get_doctor_details?ids=1,2,3
+MAX_DOCTOR_IDS = 500  # Keeps the IN (...) list well under SQLite's bound-parameter limit
+
+@main.route('/get_doctor_details')
+@login_required
+def get_doctor_details_batch():
+    try:
+        ids = {int(i) for i in request.args.get('ids', '').split(',') if i.strip()}
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of integers'}), 400
+    if not ids:
+        return jsonify({'error': 'No doctor ids given'}), 400
+    if len(ids) > MAX_DOCTOR_IDS:
+        return jsonify({'error': f'At most {MAX_DOCTOR_IDS} doctor ids per request'}), 400
+
+    doctors = Staff.query.filter(Staff.EmpID.in_(ids)).all()
+    return jsonify({str(doctor.EmpID): doctor_fee_details(doctor) for doctor in doctors})
+
+# Route to Fetch All Doctor Fees
+# Requested as /doctor_fees.json?v=<version>: a matching version is cached for a long time,
+# anything else is revalidated with the ETag
+@main.route('/doctor_fees.json')
+@login_required
+def doctor_fees():
+    snapshot, version = doctor_fee_snapshot(Staff.query.all())
+
+    response = Response(snapshot, mimetype='application/json')
+    response.set_etag(version)
+    response.cache_control.private = True  # Fee data is only for logged-in users
+    if request.args.get('v') == version:
+        response.cache_control.max_age = 31536000  # A new version gets a new URL
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 # Route to View Full Receipt
 @main.route('/full_receipt/<int:invoice_id>')
 def full_receipt(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice, billings = get_receipt_records(invoice_id)  # Also resolves archived invoices
     doctor = Staff.query.get(invoice.RefEmpID)
     pay_period = PayPeriod.query.get(invoice.RefPeriodSerial)
-    billings = Billing.query.filter_by(RefInvID=invoice_id).all()
 
     total_billing = sum(b.BillingAmount for b in billings)
     facility_fee_percent = doctor.FacilityFees_Percent if doctor else 0.0
@@ -250,10 +311,9 @@ def full_receipt(invoice_id):
 # Route to Download Receipt
 @main.route('/download_receipt/<int:invoice_id>')
 def download_receipt(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice, billings = get_receipt_records(invoice_id)  # Also resolves archived invoices
     doctor = Staff.query.get(invoice.RefEmpID)
     pay_period = PayPeriod.query.get(invoice.RefPeriodSerial)
-    billings = Billing.query.filter_by(RefInvID=invoice_id).all()
 
     total_billing = sum(b.BillingAmount for b in billings)
     facility_fee_percent = doctor.FacilityFees_Percent if doctor else 0.0
@@ -302,22 +362,40 @@ def view_past_receipts():
     if current_user.role not in ["Admin", "Super Admin"]:  # Allow both Admin and Super Admin
         flash("Unauthorized access!", "danger")
         return redirect(url_for('main.home'))
-    invoices = Invoice.query.all()  # Fetch all invoices
+    # Archived receipts are opt-in: /admin/view-receipts?include_archived=1[&year=2024]
+    include_archived = request.args.get('include_archived') == '1'
+    year = request.args.get('year', type=int)
+    if year is not None and not MINYEAR <= year <= MAXYEAR:
+        flash(f"Year must be between {MINYEAR} and {MAXYEAR}; showing all archived receipts.", "warning")
+        year = None
+
+    invoices = [(invoice, False) for invoice in Invoice.query.all()]  # Fetch all active invoices
     staff = Staff.query.all()  # Fetch all staff members
-    billings = Billing.query.all()  # Fetch all billings
-
-    # Group data by invoice ID
+    billings = Billing.query.all()  # Fetch all active billings
+
+    if include_archived:
+        archived_query = InvoiceArchive.query
+        if year:
+            archived_query = archived_query.filter(InvoiceArchive.InvDate.between(date(year, 1, 1), date(year, 12, 31)))
+        archived_invoices = archived_query.all()
+        invoices += [(invoice, True) for invoice in archived_invoices]
+        billings += BillingArchive.query.filter(
+            BillingArchive.RefInvID.in_([invoice.InvID for invoice in archived_invoices])
+        ).all()
+
+    # Group data by invoice ID (active and archived IDs never overlap)
     receipts = []
-    for invoice in invoices:
+    for invoice, archived in invoices:
         doctor = next((s for s in staff if s.EmpID == invoice.RefEmpID), None)
         invoice_billings = [b for b in billings if b.RefInvID == invoice.InvID]
         receipts.append({
             "invoice": invoice,
             "doctor": doctor,
-            "billings": invoice_billings
+            "billings": invoice_billings,
+            "archived": archived
         })
 
-    return render_template('view_receipts.html', receipts=receipts)
+    return render_template('view_receipts.html', receipts=receipts, include_archived=include_archived, year=year)
 
 # Route for System Settings
 @main.route('/system_settings')
@@ -349,12 +427,15 @@ def view_invoices():
         flash("Unauthorized access!", "danger")
         return redirect(url_for('main.home'))
     invoices = Invoice.query.all()
-    if not invoices:
+    # Opt-in: rows from closed pay periods are passed separately so they are never treated as live Invoice rows
+    archived_invoices = InvoiceArchive.query.all() if request.args.get('include_archived') == '1' else []
+    if not invoices and not archived_invoices:
         flash("No data available in the Invoices table.", "info")
     return render_template(
         'view_table.html',
         title="Invoices",
         table_data=invoices,
+        archived_data=archived_invoices,
         table_name="invoices",  # Pass unique table_name
         getattr=getattr
     )
@@ -367,12 +448,15 @@ def view_billings():
         flash("Unauthorized access!", "danger")
         return redirect(url_for('main.home'))
     billings = Billing.query.all()
-    if not billings:
+    # Opt-in: rows from closed pay periods are passed separately so they are never treated as live Billing rows
+    archived_billings = BillingArchive.query.all() if request.args.get('include_archived') == '1' else []
+    if not billings and not archived_billings:
         flash("No data available in the Billings table.", "info")
     return render_template(
         'view_table.html',
         title="Billings",
         table_data=billings,
+        archived_data=archived_billings,
         table_name="billings",  # Pass unique table_name
         getattr=getattr
     )
@@ -470,6 +554,29 @@ def add_pay_period():
 
     return redirect(url_for('main.view_pay_periods'))
 
+# Archive Closed Pay Periods
+@main.route('/system_settings/archive_pay_periods', methods=['POST'])
+@login_required
+def archive_pay_periods():
+    if current_user.role != "Super Admin":
+        flash("Unauthorized access!", "danger")
+        return redirect(url_for('main.system_settings'))
+
+    try:
+        period_count, invoice_count, held_back_count = archive_closed_pay_periods()
+        if period_count:
+            flash(f"Archived {invoice_count} invoices from {period_count} closed pay periods.", "success")
+        elif not held_back_count:
+            flash("No closed pay periods to archive.", "info")
+        if held_back_count:
+            flash(f"{held_back_count} closed pay period(s) hold the latest invoice or billing ID and were kept active.", "warning")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error archiving Pay Periods: {e}")
+        flash(f"Error archiving Pay Periods: {str(e)}", "danger")
+
+    return redirect(url_for('main.view_pay_periods'))
+
 # Add Staff Entry
 @main.route('/system_settings/add_staff', methods=['POST'])
 @login_required
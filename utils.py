@@ -1,7 +1,24 @@
+from datetime import date
+import hashlib
+import json
+import threading
+
+from flask import abort
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
+from sqlalchemy import func, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+from app.models import db, Invoice, Billing, PayPeriod, InvoiceSequence, InvoiceArchive, BillingArchive
+
+# Invoice numbers are reserved from the database in blocks, so each worker only
+# touches the shared counter once every INVOICE_BLOCK_SIZE invoices.
+INVOICE_BLOCK_SIZE = 20
+_invoice_blocks = {}  # PeriodSerial -> [next number, end of block (exclusive)]
+_invoice_block_locks = {}  # PeriodSerial -> lock guarding that period's block
+_invoice_block_locks_guard = threading.Lock()
 
 def generate_pdf(invoice, doctor, pay_period, billings, facility_fee, gst, deductions, net_payment, filename="receipt.pdf"):
     """
@@ -71,3 +88,228 @@ def generate_pdf(invoice, doctor, pay_period, billings, facility_fee, gst, deduc
     
     # Build the PDF
     doc.build(content)
+
+
+def format_invoice_number(period_serial, value):
+    """
+    Build the printed invoice number for a sequence value within a pay period.
+    """
+    return f"INV-{period_serial}-{value:05d}"
+
+
+def normalize_invoice_number(inv_number):
+    """
+    Clean up a typed invoice number so checks and inserts see the same value.
+    """
+    return (inv_number or '').strip()
+
+
+def invoice_number_exists(inv_number):
+    """
+    Check whether an invoice number is already used by an active or archived invoice.
+
+    Args:
+        inv_number (str): Normalised invoice number.
+
+    Returns:
+        bool: True if any invoice, archived or not, already has this number.
+    """
+    return any(
+        db.session.query(model.query.filter_by(InvNumber=inv_number).exists()).scalar()
+        for model in (Invoice, InvoiceArchive)
+    )
+
+
+def _reserve_invoice_block(period_serial):
+    """
+    Reserve the next block of sequence values for a pay period.
+
+    The counter row is bumped with a single UPDATE, so concurrent workers each
+    get a disjoint block without reading and re-writing the value themselves.
+    This runs and commits on its own connection, so whatever the caller has
+    pending in db.session is left untouched.
+
+    Returns:
+        list: [first value in the block, end of the block (exclusive)].
+    """
+    sequence = InvoiceSequence.__table__
+    try:
+        with db.engine.begin() as connection:
+            bumped = connection.execute(
+                update(sequence)
+                .where(sequence.c.RefPeriodSerial == period_serial)
+                .values(NextValue=sequence.c.NextValue + INVOICE_BLOCK_SIZE)
+            )
+            if bumped.rowcount == 0:
+                # First invoice of this period: create the counter
+                connection.execute(insert(sequence).values(RefPeriodSerial=period_serial, NextValue=1 + INVOICE_BLOCK_SIZE))
+                return [1, 1 + INVOICE_BLOCK_SIZE]
+
+            end = connection.execute(
+                select(sequence.c.NextValue).where(sequence.c.RefPeriodSerial == period_serial)
+            ).scalar()
+    except IntegrityError:
+        # Another worker created the counter first; bump the row it inserted instead
+        return _reserve_invoice_block(period_serial)
+
+    return [end - INVOICE_BLOCK_SIZE, end]
+
+
+def allocate_invoice_number(period_serial):
+    """
+    Hand out the next unused invoice number for a pay period.
+
+    Numbers come from a block held by this worker, so most calls only run a cheap
+    existence check. Values someone already typed by hand are skipped, as are
+    numbers left in a block when the worker exits, which leaves gaps in the
+    sequence but never duplicates.
+
+    Args:
+        period_serial (int): PeriodSerial of an existing pay period.
+
+    Returns:
+        str: Invoice number such as "INV-3-00042".
+    """
+    with _invoice_block_locks_guard:
+        period_lock = _invoice_block_locks.setdefault(period_serial, threading.Lock())
+
+    while True:
+        # Only this period waits while its next block is reserved
+        with period_lock:
+            block = _invoice_blocks.get(period_serial)
+            if block is None or block[0] >= block[1]:
+                block = _invoice_blocks[period_serial] = _reserve_invoice_block(period_serial)
+            value = block[0]
+            block[0] += 1
+
+        inv_number = format_invoice_number(period_serial, value)
+        if not invoice_number_exists(inv_number):
+            return inv_number
+
+
+def _copy_columns(row, model):
+    """
+    Build a new instance of `model` carrying over every column value of `row`.
+    """
+    return model(**{column.key: getattr(row, column.key) for column in model.__table__.columns})
+
+
+def _reuses_deleted_ids(model):
+    """
+    Check whether the database may hand out the ID of a deleted row again.
+
+    SQLite tables created without AUTOINCREMENT take max(rowid) + 1 for new rows,
+    so deleting the row with the highest ID frees that ID for the next insert.
+    Adding sqlite_autoincrement to the model does not change a table that
+    already exists.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    table_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': model.__tablename__}
+    ).scalar()
+    return 'AUTOINCREMENT' not in (table_sql or '').upper()
+
+
+def archive_closed_pay_periods(today=None):
+    """
+    Move invoices and billings of closed pay periods into the archive tables.
+
+    A pay period is closed once its end date has passed and every invoice in it
+    has been paid. Rows keep their original IDs, so receipt links stay valid.
+    Where a table could reuse deleted IDs, a period holding that table's
+    highest ID is held back, otherwise the next new row would take over the ID
+    of an archived one.
+
+    Args:
+        today (date): Reference date for deciding which periods have ended.
+
+    Returns:
+        tuple: (number of pay periods archived, number of invoices archived,
+        number of closed pay periods held back).
+    """
+    today = today or date.today()
+    unpaid_periods = db.session.query(Invoice.RefPeriodSerial).filter(
+        Invoice.PaidOn.is_(None),
+        Invoice.RefPeriodSerial.isnot(None)  # A NULL here would make NOT IN match nothing
+    )
+    closed_periods = PayPeriod.query.filter(
+        PayPeriod.Period_End_Date < today,
+        PayPeriod.invoices.any(),
+        ~PayPeriod.PeriodSerial.in_(unpaid_periods)
+    ).all()
+
+    # The highest IDs never move to the archive, so they stay the same for the whole run
+    max_invoice_id = db.session.query(func.max(Invoice.InvID)).scalar() if _reuses_deleted_ids(Invoice) else None
+    max_billing_id = db.session.query(func.max(Billing.BillingID)).scalar() if _reuses_deleted_ids(Billing) else None
+
+    archived_periods = 0
+    archived_invoices = 0
+    for period in closed_periods:
+        invoices = Invoice.query.filter_by(RefPeriodSerial=period.PeriodSerial).all()
+        invoice_ids = [invoice.InvID for invoice in invoices]
+        billings = Billing.query.filter(Billing.RefInvID.in_(invoice_ids)).all()
+
+        if max_invoice_id in invoice_ids or max_billing_id in [billing.BillingID for billing in billings]:
+            continue
+
+        db.session.add_all(_copy_columns(invoice, InvoiceArchive) for invoice in invoices)
+        db.session.flush()
+        db.session.add_all(_copy_columns(billing, BillingArchive) for billing in billings)
+        Billing.query.filter(Billing.RefInvID.in_(invoice_ids)).delete(synchronize_session=False)
+        Invoice.query.filter(Invoice.InvID.in_(invoice_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        archived_periods += 1
+        archived_invoices += len(invoices)
+
+    return archived_periods, archived_invoices, len(closed_periods) - archived_periods
+
+
+def get_receipt_records(invoice_id):
+    """
+    Load an invoice and its billings, falling back to the archive tables.
+
+    Args:
+        invoice_id (int): InvID of the invoice.
+
+    Returns:
+        tuple: (invoice, billings) from either the active or the archive tables.
+    """
+    invoice = Invoice.query.get(invoice_id)
+    if invoice:
+        return invoice, Billing.query.filter_by(RefInvID=invoice_id).all()
+
+    invoice = InvoiceArchive.query.get(invoice_id)
+    if not invoice:
+        abort(404)
+    return invoice, BillingArchive.query.filter_by(RefInvID=invoice_id).all()
+
+
+def doctor_fee_details(doctor):
+    """
+    Facility fee percentage and GST for a doctor, as returned to the invoice forms.
+    """
+    return {
+        'facility_fee': doctor.FacilityFees_Percent,
+        'gst': doctor.FacilityFees_Percent * 0.1
+    }
+
+
+def doctor_fee_snapshot(doctors):
+    """
+    Build a compact snapshot of every doctor's fees for the browser to cache.
+
+    Args:
+        doctors (list): Staff rows to include.
+
+    Returns:
+        tuple: (JSON string keyed by EmpID, version hash of that string).
+    """
+    snapshot = json.dumps(
+        {str(doctor.EmpID): doctor_fee_details(doctor) for doctor in doctors},
+        separators=(',', ':'),
+        sort_keys=True
+    )
+    version = hashlib.sha1(snapshot.encode('utf-8')).hexdigest()[:12]
+    return snapshot, version